@@ -1,14 +1,13 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+from numba import njit, prange
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
 import joblib
-import pydeck as pdk
-import plotly.express as px
-import plotly.graph_objects as go
-import io
 import os
 from datetime import datetime
-from azure.identity import DefaultAzureCredential
-from azure.storage.filedatalake import DataLakeServiceClient
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -16,8 +15,11 @@ load_dotenv()
 
 # Configuration
 STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
-MODEL_PATH = os.path.join("src", "models", "ridership_model.pkl")
-ENCODER_PATH = os.path.join("src", "models", "station_encoder.pkl")
+MODEL_PATH = os.path.join("src", "models", "ridership_pipeline.pkl")
+STATION_INDEX_PATH = "gold/station_index.parquet"
+H3_PATH = "gold/ridership_h3.parquet"
+# Keep string columns Arrow-backed: lookups compare contiguous buffers, no Python str objects
+ARROW_STRINGS = {pa.string(): pd.StringDtype("pyarrow")}
 
 # Page Config
 st.set_page_config(
@@ -66,37 +68,109 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Helper Functions ---
-def get_service_client():
-    if not STORAGE_ACCOUNT_NAME:
-        return None
-    credential = DefaultAzureCredential()
-    return DataLakeServiceClient(
-        account_url=f"https://{STORAGE_ACCOUNT_NAME}.dfs.core.windows.net", 
-        credential=credential
-    )
+# Heavy chart libraries are imported on first render, not on Streamlit boot
+@st.cache_resource
+def _pydeck():
+    import pydeck as pdk
+    return pdk
+
+@st.cache_resource
+def _plotly():
+    import plotly.express as px
+    return px
+
+@st.cache_resource
+def get_filesystem():
+    """One Azure filesystem (and credential chain) per process, shared by every read"""
+    return pafs.AzureFileSystem(account_name=STORAGE_ACCOUNT_NAME)
 
 @st.cache_data(ttl=3600)
-def load_gold_data():
-    """Download Gold data from Azure"""
-    if not STORAGE_ACCOUNT_NAME:
-        return None
-    
+def load_station_index():
+    """One row per station: latitude and longitude"""
     try:
-        client = get_service_client().get_file_system_client("gold").get_file_client("ridership_features.parquet")
-        download = client.download_file()
-        return pd.read_parquet(io.BytesIO(download.readall()))
+        table = ds.dataset(STATION_INDEX_PATH, filesystem=get_filesystem(), format="parquet").to_table()
+        df = table.to_pandas(types_mapper=ARROW_STRINGS.get)
+        return df.set_index('station_complex').sort_index()
     except Exception as e:
         st.error(f"Failed to load data from Azure: {e}")
         return None
 
+@st.cache_data(ttl=3600)
+def load_hex_data():
+    """Network-wide ridership pre-aggregated into H3 hexagons by the ETL"""
+    table = ds.dataset(H3_PATH, filesystem=get_filesystem(), format="parquet").to_table()
+    return table.to_pandas(types_mapper=ARROW_STRINGS.get)
+
 @st.cache_resource
 def load_model():
+    """Station encoder + regressor as one fitted sklearn Pipeline"""
     try:
-        model = joblib.load(MODEL_PATH)
-        le = joblib.load(ENCODER_PATH)
-        return model, le
+        return joblib.load(MODEL_PATH)
     except FileNotFoundError:
-        return None, None
+        return None
+
+@njit(parallel=True, cache=True)
+def predict_trees(roots, feature, threshold, missing_left, left, right, is_leaf, value, baseline, X):
+    """Sum of leaf values over all boosted trees for each row of X"""
+    out = np.empty(X.shape[0])
+    for i in prange(X.shape[0]):
+        acc = baseline
+        for t in range(roots.shape[0]):
+            node = roots[t]
+            while not is_leaf[node]:
+                x = X[i, feature[node]]
+                if np.isnan(x):
+                    go_left = missing_left[node]
+                else:
+                    go_left = x <= threshold[node]
+                node = left[node] if go_left else right[node]
+            acc += value[node]
+        out[i] = acc
+    return out
+
+def build_numba_predictor(model):
+    """
+    Flattens a fitted HistGradientBoostingRegressor (squared error loss) into
+    contiguous node arrays and returns a predict(X) backed by predict_trees.
+    """
+    nodes = [predictors[0].nodes for predictors in model._predictors]
+    offsets = np.cumsum([0] + [len(n) for n in nodes[:-1]])
+    flat = np.concatenate(nodes)
+    
+    roots = offsets.astype(np.int32)
+    feature = flat['feature_idx'].astype(np.int32)
+    threshold = flat['num_threshold'].astype(np.float64)
+    missing_left = flat['missing_go_to_left'].astype(np.bool_)
+    # Child indices are per-tree; shift them into the flattened arrays
+    left = np.concatenate([n['left'] + o for n, o in zip(nodes, offsets)]).astype(np.int32)
+    right = np.concatenate([n['right'] + o for n, o in zip(nodes, offsets)]).astype(np.int32)
+    is_leaf = flat['is_leaf'].astype(np.bool_)
+    value = flat['value'].astype(np.float64)
+    baseline = float(np.ravel(model._baseline_prediction)[0])
+    
+    def predict(X):
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        return predict_trees(roots, feature, threshold, missing_left, left, right, is_leaf, value, baseline, X)
+    return predict
+
+@st.cache_resource
+def compiled_predictor(_model):
+    return build_numba_predictor(_model)
+
+@st.cache_data(ttl=3600, max_entries=2000)
+def predict_day(station: str, day_of_week: int, lat: float, lon: float) -> np.ndarray:
+    """24-hour ridership forecast; the hour slider reuses the cached curve"""
+    model = load_model()
+    trend_input = pd.DataFrame({
+        'station_complex': [station] * 24,
+        'hour': np.arange(24),
+        'day_of_week': np.full(24, day_of_week),
+        'latitude': np.full(24, lat),
+        'longitude': np.full(24, lon)
+    })
+    # Encode the whole batch with the pipeline, then walk the trees with the Numba kernel
+    features = model[:-1].transform(trend_input)
+    return compiled_predictor(model[-1])(features)
 
 # --- Main App ---
 st.title("🚇 MTA Transit Brain")
@@ -107,11 +181,11 @@ if not STORAGE_ACCOUNT_NAME:
     st.stop()
 
 with st.spinner("Connecting to Azure Data Lake..."):
-    df = load_gold_data()
+    station_index = load_station_index()
 
-model, le = load_model()
+model = load_model()
 
-if df is None:
+if station_index is None:
     st.warning("⚠️ Data access failed. Check your Azure connection.")
 elif model is None:
     st.warning("⚠️ Model not found. Run `src/models/forecaster.py` to train it.")
@@ -119,8 +193,7 @@ else:
     # --- Sidebar Controls ---
     st.sidebar.markdown("### 🎛️ Control Panel")
     
-    stations = sorted(df['station_complex'].unique())
-    selected_station = st.sidebar.selectbox("Select Station", stations, index=0)
+    selected_station = st.sidebar.selectbox("Select Station", station_index.index, index=0)
     
     st.sidebar.markdown("---")
     forecast_date = st.sidebar.date_input("Forecast Date", datetime.now().date())
@@ -131,21 +204,16 @@ else:
 
     # --- Prediction Logic ---
     day_of_week = forecast_date.weekday()
-    station_data = df[df['station_complex'] == selected_station].iloc[0]
-    lat, lon = station_data['latitude'], station_data['longitude']
+    station_data = station_index.loc[selected_station]
+    # Stored as float32; plain floats so pydeck serialises them as JSON numbers
+    lat, lon = float(station_data['latitude']), float(station_data['longitude'])
     
     try:
-        # Predict
-        station_encoded = le.transform([selected_station])[0]
-        input_data = pd.DataFrame({
-            'station_id_encoded': [station_encoded],
-            'hour': [forecast_hour],
-            'day_of_week': [day_of_week],
-            'latitude': [lat],
-            'longitude': [lon]
-        })
+        # Predict the full day in one batch; the metric reads the selected hour from it
+        hours = np.arange(24)
+        trend_preds = predict_day(selected_station, day_of_week, lat, lon)
         
-        prediction = int(model.predict(input_data)[0])
+        prediction = int(trend_preds[forecast_hour])
         
         # --- Metrics Row ---
         col1, col2, col3 = st.columns(3)
@@ -178,7 +246,7 @@ else:
             st.metric(
                 label="Confidence Score", 
                 value="96.5%", 
-                delta="Random Forest v1"
+                delta="Gradient Boosting v2"
             )
 
         # --- Visualizations ---
@@ -186,15 +254,16 @@ else:
         col_map, col_chart = st.columns([1.2, 1]) # Map slightly wider
 
         with col_map:
-            # Heatmap layer for ALL stations (Context)
-            heatmap_layer = pdk.Layer(
-                "HeatmapLayer",
-                data=df,
-                get_position=['longitude', 'latitude'],
-                get_weight="avg_ridership",
-                radius_pixels=60,
-                intensity=1,
-                threshold=0.3,
+            pdk = _pydeck()
+            # Hexagon layer for ALL stations (Context)
+            hex_layer = pdk.Layer(
+                "H3HexagonLayer",
+                data=load_hex_data(),
+                get_hexagon="h3",
+                get_elevation="total_ridership",
+                elevation_scale=0.01,
+                extruded=True,
+                get_fill_color=[0, 168, 204, 120],
                 opacity=0.4
             )
             
@@ -221,22 +290,13 @@ else:
             st.pydeck_chart(pdk.Deck(
                 map_style='mapbox://styles/mapbox/dark-v11', # Premium Dark Map
                 initial_view_state=view_state,
-                layers=[heatmap_layer, scatter_layer],
+                layers=[hex_layer, scatter_layer],
                 tooltip={"text": f"{selected_station}"}
             ))
 
         with col_chart:
+            px = _plotly()
             # 24-Hour Trend Chart using Plotly
-            hours = list(range(24))
-            trend_input = pd.DataFrame({
-                'station_id_encoded': [station_encoded]*24, 
-                'hour': hours, 
-                'day_of_week': [day_of_week]*24, 
-                'latitude': [lat]*24, 
-                'longitude': [lon]*24
-            })
-            trend_preds = model.predict(trend_input)
-            
             trend_df = pd.DataFrame({'Hour': hours, 'Ridership': trend_preds})
             
             fig = px.area(
@@ -1,5 +1,6 @@
 import requests
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
 from datetime import datetime
 from azure.identity import DefaultAzureCredential
@@ -12,6 +13,7 @@ load_dotenv()
 # Configuration
 MTA_DATA_URL = "https://data.ny.gov/api/views/wujg-7c2s/rows.csv?accessType=DOWNLOAD"
 STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME") 
+UPLOAD_WORKERS = 8
 
 def get_service_client():
     if not STORAGE_ACCOUNT_NAME:
@@ -34,12 +36,13 @@ def fetch_and_upload_data():
         print("ERROR: AZURE_STORAGE_ACCOUNT_NAME env var missing. Run 'export AZURE_STORAGE_ACCOUNT_NAME=...'")
         return
 
+    file_client = None
     try:
         service_client = get_service_client()
         file_system_client = service_client.get_file_system_client("bronze")
         
-        # Define target file path in Data Lake
-        file_client = file_system_client.get_file_client("ridership_raw.csv")
+        # Stage into a temp path; the real Bronze file is only replaced once the upload is complete
+        file_client = file_system_client.get_file_client("ridership_raw.csv.partial")
         
         print(f"[{datetime.now()}] Downloading data stream from MTA...")
         # Stream download keeping memory usage low for large files
@@ -47,25 +50,47 @@ def fetch_and_upload_data():
         response.raise_for_status()
         
         print(f"[{datetime.now()}] Uploading to Azure ADLS (bronze/ridership_raw.csv)...")
-        # Upload data
-        chunk_size = 10 * 1024 * 1024 # 10MB
-        total_size = 0
+        # Stream chunks straight into ADLS (append_data + flush_data) instead of buffering in RAM
+        chunk_size = 8 * 1024 * 1024 # 8MB
         max_size = 500 * 1024 * 1024 # 500MB limit for better accuracy
         
-        data = b""
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            data += chunk
-            total_size += len(chunk)
-            print(f"Downloaded {total_size / (1024*1024):.1f} MB...")
-            if total_size > max_size:
-                break
+        file_client.create_file()
+        offset = 0
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            pending = set()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if not chunk:
+                    continue
+                # Offset is fixed before submission so chunks can land in any order
+                pending.add(executor.submit(file_client.append_data, chunk, offset, len(chunk)))
+                offset += len(chunk)
+                print(f"Queued {offset / (1024*1024):.1f} MB...")
                 
-        file_client.upload_data(data, overwrite=True)
+                # Bound in-flight chunks so memory stays at ~2x workers * chunk_size
+                if len(pending) >= UPLOAD_WORKERS * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        
+                if offset > max_size:
+                    break
+                    
+            for future in wait(pending).done:
+                future.result()
+                
+        # Commit the appended chunks, then swap them in over the previous Bronze file
+        file_client.flush_data(offset)
+        file_client.rename_file("bronze/ridership_raw.csv")
         
         print(f"[{datetime.now()}] Upload Complete.")
         
     except Exception as e:
         print(f"ERROR: {e}")
+        if file_client is not None:
+            try:
+                file_client.delete_file()
+            except Exception:
+                pass
 
 if __name__ == "__main__":
     fetch_and_upload_data()
@@ -1,14 +1,19 @@
-import pandas as pd
-import io
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import asyncio
 import os
 import joblib
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OrdinalEncoder
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import mean_absolute_error
 from datetime import datetime
-from azure.identity import DefaultAzureCredential
-from azure.storage.filedatalake import DataLakeServiceClient
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential
+from azure.storage.filedatalake.aio import DataLakeServiceClient
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -16,23 +21,24 @@ load_dotenv()
 
 # Configuration
 STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
+DOWNLOAD_CONCURRENCY = 8 # Parallel range requests once a file exceeds the SDK's single-GET size
+FEATURES = ['station_complex', 'hour', 'day_of_week', 'latitude', 'longitude']
 
-def get_service_client():
-    if not STORAGE_ACCOUNT_NAME:
-        raise ValueError("Environment variable AZURE_STORAGE_ACCOUNT_NAME is not set.")
-    
-    credential = DefaultAzureCredential()
-    service_client = DataLakeServiceClient(
-        account_url=f"https://{STORAGE_ACCOUNT_NAME}.dfs.core.windows.net", 
-        credential=credential
-    )
-    return service_client
+async def read_parquet_from_datalake_async(file_system, file_path):
+    """Downloads the file over aiohttp and parses it with PyArrow"""
+    async with DefaultAzureCredential() as credential, DataLakeServiceClient(
+        account_url=f"https://{STORAGE_ACCOUNT_NAME}.dfs.core.windows.net",
+        credential=credential,
+        transport=AioHttpTransport()
+    ) as service_client:
+        client = service_client.get_file_system_client(file_system).get_file_client(file_path)
+        # The SDK splits large files into concurrent ranges itself; small ones stay a single GET
+        download = await client.download_file(max_concurrency=DOWNLOAD_CONCURRENCY)
+        data = await download.readall()
+    return pq.read_table(pa.BufferReader(data)).to_pandas()
 
 def read_parquet_from_datalake(file_system, file_path):
-    client = get_service_client().get_file_system_client(file_system).get_file_client(file_path)
-    download = client.download_file()
-    downloaded_bytes = download.readall()
-    return pd.read_parquet(io.BytesIO(downloaded_bytes))
+    return asyncio.run(read_parquet_from_datalake_async(file_system, file_path))
 
 def train_model():
     print(f"[{datetime.now()}] Starting Model Training (Source: Azure Gold)...")
@@ -48,17 +54,21 @@ def train_model():
         print(f"ERROR reading Gold data: {e}")
         return
 
-    # Preprocessing
-    le = LabelEncoder()
-    df['station_id_encoded'] = le.fit_transform(df['station_complex'])
-    
-    X = df[['station_id_encoded', 'hour', 'day_of_week', 'latitude', 'longitude']]
-    y = df['avg_ridership']
+    # Raw features; the pipeline encodes station_complex itself
+    X = df[FEATURES]
+    y = df['avg_ridership'].to_numpy(dtype=np.float32)
     
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
     
-    print(f"[{datetime.now()}] Training Random Forest Regressor...")
-    model = RandomForestRegressor(n_estimators=50, random_state=42, n_jobs=-1)
+    print(f"[{datetime.now()}] Training Histogram Gradient Boosting Pipeline...")
+    # Encoded station comes out first, followed by the passthrough numeric features
+    model = Pipeline([
+        ('enc', ColumnTransformer(
+            [('station', OrdinalEncoder(dtype=np.float32, handle_unknown='use_encoded_value', unknown_value=np.nan), ['station_complex'])],
+            remainder='passthrough'
+        )),
+        ('gbr', HistGradientBoostingRegressor(max_iter=200, max_bins=255, early_stopping=True, random_state=42))
+    ])
     model.fit(X_train, y_train)
     
     predictions = model.predict(X_test)
@@ -68,8 +78,7 @@ def train_model():
     # Save Model Locally (for App usage)
     # We also upload these to a container? For now local is fine for the App.
     os.makedirs("src/models", exist_ok=True)
-    joblib.dump(model, "src/models/ridership_model.pkl")
-    joblib.dump(le, "src/models/station_encoder.pkl")
+    joblib.dump(model, "src/models/ridership_pipeline.pkl", compress=3)
     print(f"[{datetime.now()}] Model saved locally.")
 
 if __name__ == "__main__":
@@ -1,7 +1,16 @@
-import pandas as pd
+import duckdb
+import h3
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import csv
 import io
 import os
+import functools
+import tempfile
 from datetime import datetime
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import DefaultAzureCredential
 from azure.storage.filedatalake import DataLakeServiceClient
 from dotenv import load_dotenv
@@ -11,34 +20,147 @@ load_dotenv()
 
 # Configuration
 STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
+CSV_BLOCK_SIZE = 16 << 20 # 16MB blocks; peak memory is a few blocks, not the whole file
+DICTIONARY_COLUMNS = ['station_complex', 'borough'] # Low-cardinality strings
+H3_RESOLUTION = 8 # ~0.7 km2 hexagons
+SORTED_ROW_GROUP_SIZE = 16 * 1024 # Small row groups so min/max stats can skip by the sort key
+# Narrowest types that hold each feature (hour 0-23, day_of_week 0-6)
+COMPACT_TYPES = {
+    'hour': pa.int8(),
+    'day_of_week': pa.int8(),
+    'latitude': pa.float32(),
+    'longitude': pa.float32(),
+    'avg_ridership': pa.float32(),
+    'total_ridership': pa.float32()
+}
+# Local scratch for the Silver file and DuckDB spill (defaults to the system temp dir)
+WORK_DIRECTORY = os.getenv("ETL_WORK_DIRECTORY")
+TIMESTAMP_FORMAT = "%m/%d/%Y %I:%M:%S %p" # e.g. 01/31/2024 08:00:00 AM
+# Pinned Bronze types skip PyArrow's type inference pass
+BRONZE_COLUMN_TYPES = {
+    'transit_timestamp': pa.timestamp('s'),
+    'station_complex': pa.string(),
+    'borough': pa.string(),
+    'ridership': pa.int32(),
+    'latitude': pa.float32(),
+    'longitude': pa.float32()
+}
 
+@functools.lru_cache(maxsize=1)
 def get_service_client():
+    """One client (credential + keep-alive HTTP session) shared by every read/write in a run"""
     if not STORAGE_ACCOUNT_NAME:
         raise ValueError("Environment variable AZURE_STORAGE_ACCOUNT_NAME is not set.")
     
     credential = DefaultAzureCredential()
     service_client = DataLakeServiceClient(
         account_url=f"https://{STORAGE_ACCOUNT_NAME}.dfs.core.windows.net", 
-        credential=credential
+        credential=credential,
+        transport=RequestsTransport(connection_timeout=30, read_timeout=300)
     )
     return service_client
 
-def read_csv_from_datalake(file_system, file_path):
+class DownloadStream(io.RawIOBase):
+    """Read-only file object over an ADLS download's chunks() iterator."""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            self._pending = next(self._chunks, None)
+            if self._pending is None:
+                self._pending = b""
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+def open_csv_from_datalake(file_system, file_path, columns=None, column_types=None):
+    """
+    Opens a CSV in ADLS as a streaming Arrow batch reader; only one block is held at a time.
+    Column names are normalised to snake_case; only `columns` are parsed when given.
+    """
     client = get_service_client().get_file_system_client(file_system).get_file_client(file_path)
-    download = client.download_file()
-    downloaded_bytes = download.readall()
-    return pd.read_csv(io.BytesIO(downloaded_bytes))
+    stream = io.BufferedReader(DownloadStream(client.download_file().chunks()), buffer_size=CSV_BLOCK_SIZE)
+    
+    # Consume the header ourselves so names can be normalised before parsing
+    header = next(csv.reader([stream.readline().decode("utf-8-sig")]))
+    column_names = [c.strip().lower().replace(' ', '_') for c in header]
+    include_columns = [c for c in columns if c in column_names] if columns else column_names
+    
+    return pa_csv.open_csv(
+        stream,
+        read_options=pa_csv.ReadOptions(column_names=column_names, block_size=CSV_BLOCK_SIZE, use_threads=True),
+        parse_options=pa_csv.ParseOptions(delimiter=','),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=include_columns,
+            column_types={c: t for c, t in (column_types or {}).items() if c in include_columns},
+            timestamp_parsers=[pa_csv.ISO8601, TIMESTAMP_FORMAT]
+        )
+    )
+
+def parquet_write_options(table_schema):
+    """Shared pq.write_table / pq.ParquetWriter options."""
+    return dict(
+        compression="zstd",
+        compression_level=3,
+        use_dictionary=[c for c in DICTIONARY_COLUMNS if c in table_schema.names],
+        data_page_size=1 << 20,
+        write_statistics=True
+    )
 
-def write_parquet_to_datalake(df, file_system, file_path):
+def write_parquet_to_datalake(table, file_system, file_path, sort_by=None):
     client = get_service_client().get_file_system_client(file_system).get_file_client(file_path)
+    # Sorted + statistics lets readers skip row groups when filtering on `sort_by`
+    sorting_columns = None
+    row_group_size = None # pyarrow default for unsorted tables
+    if sort_by:
+        table = table.sort_by(sort_by)
+        sorting_columns = pq.SortingColumn.from_ordering(table.schema, [(sort_by, 'ascending')])
+        row_group_size = SORTED_ROW_GROUP_SIZE
+    
     # Convert to parquet bytes
     parquet_buffer = io.BytesIO()
-    df.to_parquet(parquet_buffer, index=False)
+    pq.write_table(
+        table,
+        parquet_buffer,
+        row_group_size=row_group_size,
+        sorting_columns=sorting_columns,
+        **parquet_write_options(table.schema)
+    )
     parquet_buffer.seek(0)
     
     # Upload
     client.upload_data(parquet_buffer.getvalue(), overwrite=True)
 
+def upload_file_to_datalake(local_path, file_system, file_path):
+    """Streams a local file to ADLS (the SDK's chunked append/flush) without reading it into memory."""
+    client = get_service_client().get_file_system_client(file_system).get_file_client(file_path)
+    with open(local_path, "rb") as f:
+        client.upload_data(f, length=os.path.getsize(local_path), overwrite=True)
+
+def silver_features(batch):
+    """Bronze batch -> Silver table: calendar features via Arrow compute kernels, compact types."""
+    table = pa.Table.from_batches([batch])
+    if 'transit_timestamp' in table.column_names:
+        ts = table['transit_timestamp']
+        table = table.append_column('date', pc.cast(ts, pa.date32()))
+        table = table.append_column('hour', pc.hour(ts))
+        table = table.append_column('day_of_week', pc.day_of_week(ts))
+    return downcast(table)
+
+def downcast(table):
+    """Casts any COMPACT_TYPES columns present in `table` to their compact type."""
+    schema = pa.schema([
+        field.with_type(COMPACT_TYPES.get(field.name, field.type)) for field in table.schema
+    ])
+    return table.cast(schema)
+
 def run_etl():
     """
     1. Read 'bronze/ridership_raw.csv' from ADLS.
@@ -46,6 +168,8 @@ def run_etl():
     3. Write 'silver/ridership_clean.parquet' to ADLS.
     4. Aggregate.
     5. Write 'gold/ridership_features.parquet' to ADLS.
+    6. Write 'gold/station_index.parquet' (one row per station) to ADLS.
+    7. Write 'gold/ridership_h3.parquet' (H3 hexagon totals for the map) to ADLS.
     """
     print(f"[{datetime.now()}] Starting ETL Pipeline (Source: Azure ADLS)...")
     
@@ -53,44 +177,104 @@ def run_etl():
         print("ERROR: AZURE_STORAGE_ACCOUNT_NAME env var missing.")
         return
 
-    # --- Step 1: Bronze to Silver ---
-    print(f"[{datetime.now()}] Reading Bronze data from Azure...")
-    try:
-        df_bronze = read_csv_from_datalake("bronze", "ridership_raw.csv")
-    except Exception as e:
-        print(f"ERROR reading bronze data: {e}")
-        return
+    with tempfile.TemporaryDirectory(dir=WORK_DIRECTORY) as work_dir:
+        silver_path = os.path.join(work_dir, "ridership_clean.parquet")
+        
+        # --- Step 1: Bronze to Silver ---
+        # Streamed batch by batch into a local Parquet file so Bronze never has to fit in RAM
+        cols_to_keep = ['transit_timestamp', 'station_complex', 'borough', 'ridership', 'latitude', 'longitude']
+        
+        print(f"[{datetime.now()}] Reading Bronze data from Azure...")
+        writer = None
+        try:
+            # Column names are normalised and pruned while parsing
+            reader = open_csv_from_datalake("bronze", "ridership_raw.csv", columns=cols_to_keep, column_types=BRONZE_COLUMN_TYPES)
+            for batch in reader:
+                silver = silver_features(batch)
+                if writer is None:
+                    writer = pq.ParquetWriter(silver_path, silver.schema, **parquet_write_options(silver.schema))
+                writer.write_table(silver)
+        except Exception as e:
+            print(f"ERROR reading bronze data: {e}")
+            return
+        finally:
+            if writer is not None:
+                writer.close()
+        
+        if writer is None:
+            print("ERROR reading bronze data: file has no rows.")
+            return
+        
+        print(f"[{datetime.now()}] Writing Silver data to Azure...")
+        upload_file_to_datalake(silver_path, "silver", "ridership_clean.parquet")
 
-    # Basic cleaning
-    df_bronze.columns = [c.lower().replace(' ', '_') for c in df_bronze.columns]
+        # --- Step 2: Silver to Gold ---
+        print(f"[{datetime.now()}] Creating Gold features...")
+        
+        # FIX: Sum ridership across different payment methods (OMNY, MetroCard) for the same hour first
+        # Group by [Station, Date, Hour] -> Sum(Ridership) = Total Crowd for that specific hour
+        # Then calculate the "Average Typical Ridership" for that hour (e.g., Average of all 8 AMs)
+        # DuckDB scans the local Silver file and spills its hash tables into work_dir when needed
+        con = duckdb.connect(config={
+            'temp_directory': os.path.join(work_dir, "duckdb"),
+            'preserve_insertion_order': False
+        })
+        con.execute("CREATE VIEW silver AS SELECT * FROM read_parquet('{}')".format(silver_path.replace("'", "''")))
+        gold = con.execute("""
+            WITH hourly_total AS (
+                SELECT station_complex, borough, latitude, longitude, date, hour, day_of_week,
+                       SUM(ridership) AS ridership
+                FROM silver
+                -- Match pandas groupby, which drops rows with missing keys
+                WHERE station_complex IS NOT NULL AND borough IS NOT NULL
+                  AND latitude IS NOT NULL AND longitude IS NOT NULL
+                  AND date IS NOT NULL
+                GROUP BY ALL
+            )
+            SELECT station_complex, borough, latitude, longitude, hour, day_of_week,
+                   AVG(ridership) AS avg_ridership
+            FROM hourly_total
+            GROUP BY ALL
+        """).fetch_arrow_table()
+        con.close()
     
-    cols_to_keep = ['transit_timestamp', 'station_complex', 'borough', 'ridership', 'latitude', 'longitude']
-    available_cols = [c for c in cols_to_keep if c in df_bronze.columns]
-    df_silver = df_bronze[available_cols].copy()
-
-    if 'transit_timestamp' in df_silver.columns:
-        df_silver['transit_timestamp'] = pd.to_datetime(df_silver['transit_timestamp'])
-        df_silver['date'] = df_silver['transit_timestamp'].dt.date
-        df_silver['hour'] = df_silver['transit_timestamp'].dt.hour
-        df_silver['day_of_week'] = df_silver['transit_timestamp'].dt.dayofweek
-    
-    print(f"[{datetime.now()}] Writing Silver data to Azure...")
-    write_parquet_to_datalake(df_silver, "silver", "ridership_clean.parquet")
-
-    # --- Step 2: Silver to Gold ---
-    # --- Step 2: Silver to Gold ---
-    print(f"[{datetime.now()}] Creating Gold features...")
+    # Gold is small (stations x 168 hour/day slots); the remaining steps run in memory
+    gold = downcast(gold)
+    con = duckdb.connect()
+    con.register('gold', gold)
     
-    # FIX: Sum ridership across different payment methods (OMNY, MetroCard) for the same hour first
-    # Group by [Station, Date, Hour] -> Sum(Ridership) = Total Crowd for that specific hour
-    df_hourly_total = df_silver.groupby(['station_complex', 'borough', 'latitude', 'longitude', 'date', 'hour', 'day_of_week'])['ridership'].sum().reset_index()
+    # Compact lookup so the dashboard never loads the full Gold table for station metadata
+    station_index = con.execute("""
+        SELECT DISTINCT ON (station_complex) station_complex, latitude, longitude
+        FROM gold
+        ORDER BY station_complex
+    """).fetch_arrow_table()
     
-    # Now calculate the "Average Typical Ridership" for that hour (e.g., Average of all 8 AMs)
-    df_gold = df_hourly_total.groupby(['station_complex', 'borough', 'latitude', 'longitude', 'hour', 'day_of_week'])['ridership'].mean().reset_index()
-    df_gold.rename(columns={'ridership': 'avg_ridership'}, inplace=True)
+    # Pre-aggregate the map layer into H3 hexagons (one h3 call per station, not per row)
+    station_h3 = pa.table({
+        'station_complex': station_index['station_complex'],
+        'h3': [
+            h3.latlng_to_cell(lat, lon, H3_RESOLUTION)
+            for lat, lon in zip(station_index['latitude'].to_pylist(), station_index['longitude'].to_pylist())
+        ]
+    })
+    con.register('station_h3', station_h3)
+    ridership_h3 = con.execute("""
+        SELECT h3, SUM(avg_ridership) AS total_ridership
+        FROM gold JOIN station_h3 USING (station_complex)
+        GROUP BY h3
+        ORDER BY h3
+    """).fetch_arrow_table()
+    con.close()
+    centers = [h3.cell_to_latlng(cell) for cell in ridership_h3['h3'].to_pylist()]
+    ridership_h3 = ridership_h3.append_column('latitude', pa.array([c[0] for c in centers]))
+    ridership_h3 = ridership_h3.append_column('longitude', pa.array([c[1] for c in centers]))
+    ridership_h3 = downcast(ridership_h3)
     
     print(f"[{datetime.now()}] Writing Gold data to Azure...")
-    write_parquet_to_datalake(df_gold, "gold", "ridership_features.parquet")
+    write_parquet_to_datalake(gold, "gold", "ridership_features.parquet", sort_by="station_complex")
+    write_parquet_to_datalake(station_index, "gold", "station_index.parquet")
+    write_parquet_to_datalake(ridership_h3, "gold", "ridership_h3.parquet")
     print(f"[{datetime.now()}] ETL Complete.")
 
 if __name__ == "__main__":